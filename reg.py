@@ -1,16 +1,24 @@
 """
 Authors: George Toumbas, Shanzay Waseem
 """
-import argparse
-from reg_db import RegDB
+import sys
+import types
+from reg_db import RegDB, RegDBError, RegDBDatabaseError
 
+# Options that each take one value, and the attribute they set
+OPTIONS = {'-d': 'd', '-n': 'n', '-a': 'a', '-t': 't'}
 
-def main():
+
+def get_parser():
     """
-    Reads arguments from the command line and
-    searches the registrar database.
+    Builds the argparse parser for reg.py. argparse is only imported
+    here, since parse_args handles well-formed arguments without it.
+
+    Returns:
+        parser (argparse.ArgumentParser): Parser for the command line
     """
     # Information from https://docs.python.org/3/howto/argparse.html
+    import argparse  # pylint: disable=import-outside-toplevel
 
     parser = argparse.ArgumentParser(
         allow_abbrev=False,
@@ -32,12 +40,49 @@ def main():
         help="show only those classes" +\
             " whose course title contains title",
         type=str)
+    return parser
+
+
+def parse_args(argv):
+    """
+    Parses "-d dept -n num -a area -t title" style arguments by hand.
+    Anything else (-h, unknown options, missing values) is handed to
+    argparse so that usage and error messages stay the same.
+
+    Args:
+        argv (list): Command line arguments without the program name
 
-    args = parser.parse_args()
+    Returns:
+        args (types.SimpleNamespace): Values of d, n, a and t
+    """
+    values = dict.fromkeys(OPTIONS.values())
+    i = 0
+    while i < len(argv):
+        if argv[i] not in OPTIONS or i + 1 == len(argv) or \
+                argv[i + 1].startswith('-'):
+            return get_parser().parse_args(argv)
+        values[OPTIONS[argv[i]]] = argv[i + 1]
+        i += 2
+    return types.SimpleNamespace(**values)
+
+
+def main():
+    """
+    Reads arguments from the command line and
+    searches the registrar database.
+    """
+    args = parse_args(sys.argv[1:])
 
-    registrar_db = RegDB()
-    registrar_db.search(args)
-    registrar_db.close()
+    try:
+        registrar_db = RegDB()
+        registrar_db.search(args)
+        registrar_db.close()
+    except RegDBDatabaseError as error:
+        sys.stderr.write(f"{sys.argv[0]}: {error}")
+        sys.exit(1)
+    except RegDBError as error:
+        sys.stderr.write(str(error))
+        sys.exit(1)
 
 
 if __name__ == '__main__':
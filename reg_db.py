@@ -2,11 +2,149 @@
 Authors: George Toumbas, Shanzay Waseem
 
 Contains the class RegDB, which can search and
-display information from the registrar database.
+display information from the registrar database,
+and RegDBError and RegDBDatabaseError, which it raises on failure.
 """
+import os
+import re
 import sqlite3
 import textwrap
+import threading
 import sys
+from urllib.parse import quote
+
+# LIKE wildcards, and the '@' escape char itself, that must be
+# escaped in search arguments
+_WILDCARDS = re.compile(r"([%_@])")
+# Translation table that deletes newline chars
+_NO_NEWLINES = str.maketrans("", "", "\n")
+# Wrappers for the details display, built once instead of per fill()
+_WRAPPER = textwrap.TextWrapper(width=72, break_long_words=False)
+_WRAPPER_BLW = textwrap.TextWrapper(width=72, break_long_words=True)
+
+
+class RegDBError(Exception):
+    """
+    Raised by RegDB when a lookup fails, e.g. an unknown class ID.
+    """
+
+
+class RegDBDatabaseError(RegDBError):
+    """
+    Raised by RegDB when the database cannot be opened or queried.
+    The message is the underlying sqlite3 error.
+    """
+
+
+class SQLiteConnectionPool:
+    """
+    Keeps one open connection per thread and database file, so that
+    a long-lived process creating many RegDB objects reuses them.
+
+    Attributes:
+        CACHED_STATEMENTS (int): Statement cache size per connection
+        PRAGMAS (str): Settings applied once to every new connection
+
+    Methods:
+        acquire(url):
+            Returns this thread's connection to url, opening it
+            if needed, and a dict cache that lives as long as it.
+        release(conn):
+            Hands a connection back to the pool without closing it.
+        close_all():
+            Closes all of this thread's pooled connections.
+        resolve_url(url):
+            Returns url with its file path made absolute.
+    """
+
+    # Large enough to keep every RegDB search query shape prepared
+    CACHED_STATEMENTS = 32
+
+    # journal_mode=WAL and synchronous=NORMAL are left out: they need
+    # a writable handle and the registrar database is opened read-only.
+    # WAL has to be set once on reg.sqlite with a writable handle
+    # (PRAGMA journal_mode=WAL); it is stored in the file, but readers
+    # then also need write access to its directory for the -shm file.
+    PRAGMAS = """
+    PRAGMA query_only=ON;
+    PRAGMA cache_size=-65536;
+    PRAGMA temp_store=MEMORY;
+    PRAGMA mmap_size=268435456;
+    """
+
+    def __init__(self):
+        self._local = threading.local()
+
+    def acquire(self, url):
+        """
+        Returns this thread's connection to url, opening it if needed.
+        Relative paths are resolved against the current directory when
+        acquire is called, so a later chdir opens the new file.
+
+        Args:
+            url (str): SQLite "file:" URI of the database
+
+        Returns:
+            conn (sqlite3.Connection): Open connection
+            cache (dict): Per-connection cache for callers, e.g. for
+                schema lookups; dropped when the connection is closed
+        """
+        conns = getattr(self._local, "conns", None)
+        if conns is None:
+            conns = self._local.conns = {}
+
+        url = self.resolve_url(url)
+        entry = conns.get(url)
+        if entry is None:
+            conn = sqlite3.connect(
+                url, isolation_level=None, uri=True,
+                cached_statements=self.CACHED_STATEMENTS)
+            try:
+                conn.executescript(self.PRAGMAS)
+            except sqlite3.Error:
+                conn.close()
+                raise
+            entry = conns[url] = (conn, {})
+        return entry
+
+    def release(self, conn):
+        """
+        Hands a connection back to the pool. The connection stays
+        open for the next acquire from the same thread until
+        close_all is called.
+
+        Args:
+            conn (sqlite3.Connection): Connection from acquire
+        """
+
+    def close_all(self):
+        """
+        Closes all of this thread's pooled connections. Later acquire
+        calls open new ones.
+        """
+        conns = getattr(self._local, "conns", None)
+        if conns:
+            for conn, _ in conns.values():
+                conn.close()
+            conns.clear()
+
+    def resolve_url(self, url):
+        """
+        Returns url with its file path made absolute, so it names the
+        same database whatever the current directory later is.
+
+        Args:
+            url (str): SQLite "file:" URI of the database
+
+        Returns:
+            url (str): URI with an absolute, percent-encoded path
+        """
+        path, sep, query = url[len("file:"):].partition("?")
+        path = quote(os.path.abspath(path))
+        return f"file:{path}{sep}{query}"
+
+
+_POOL = SQLiteConnectionPool()
 
 
 class RegDB:
@@ -18,7 +156,7 @@ class RegDB:
 
     Methods:
         close():
-            Closes connection to the db.
+            Returns connection to the db to the pool.
         search(args):
             Searches the database and displays the results.
         get_details(args):
@@ -26,34 +164,62 @@ class RegDB:
             the results.
         get_search_query(args):
             Returns a SQL query for a search based on the arguments.
+        get_search_mask(args):
+            Returns a bitmask of which search arguments are present.
+        build_search_query(mask):
+            Builds the SQL query for a search from an argument bitmask.
         get_details_query():
             Returns a SQL query for classid-based search.
         display_table(results, max_len=72):
             Creates a table from the results of sql search query.
+        write_lines(lines):
+            Writes lines to stdout in one encoded write.
         replace_wildcards(string):
-            Replaces wildcard chars with escape chars + wildcard char.
+            Escapes wildcard chars and '@' with the '@' escape char.
         format_args(args):
             Formats the arguments for the search query.
     """
 
     DB_URL = 'file:reg.sqlite?mode=ro'
 
+    # Number of prebuilt search query shapes without ESCAPE clauses
+    NUM_SEARCH_QUERIES = 16
+
+    # Columns searched by -d, -n, -a, -t
+    SEARCH_COLUMNS = ("dept", "coursenum", "area", "title")
+
+    # Number of table lines display_table writes at a time
+    TABLE_BATCH_SIZE = 256
+
     def __init__(self):
 
         try:
-            self.conn = sqlite3.connect(
-                self.DB_URL, isolation_level=None, uri=True)
+            self.conn, conn_cache = _POOL.acquire(self.DB_URL)
             self.cur = self.conn.cursor()
 
+            # Search the denormalized table if migrate() has been run.
+            # Looked up once per pooled connection.
+            if "has_wide" not in conn_cache:
+                conn_cache["has_wide"] = self.cur.execute(
+                    "SELECT 1 FROM sqlite_master "
+                    "WHERE type = 'table' AND name = 'classes_wide'"
+                ).fetchone() is not None
+            self._has_wide = conn_cache["has_wide"]
+
         except Exception as error:
-            sys.stderr.write(f"{sys.argv[0]}: {error}")
-            sys.exit(1)
+            raise RegDBDatabaseError(str(error)) from error
+
+        # Every search query without escaped wildcards, keyed by
+        # argument bitmask. Queries needing ESCAPE are added on demand.
+        self._queries = {mask: self.build_search_query(mask)
+                         for mask in range(self.NUM_SEARCH_QUERIES)}
 
     def close(self):
         """
-        Closes the connection to the database.
+        Closes the cursor and returns the connection to the pool.
         """
-        self.conn.close()
+        self.cur.close()
+        _POOL.release(self.conn)
 
     def search(self, args):
         """
@@ -61,28 +227,26 @@ class RegDB:
 
         Args:
             args (argparse.Namespace): Arguments from command line
+
+        Raises:
+            RegDBDatabaseError: If the query is unsuccessful
         """
         self.format_args(args)
         query = self.get_search_query(args)
         # Parameters set to fill in prepared statements
-        parameters = []
-        if args.d:
-            parameters.append(args.d)
-        if args.n:
-            parameters.append(args.n)
-        if args.a:
-            parameters.append(args.a)
-        if args.t:
-            parameters.append(args.t)
+        parameters = [v for v in (args.d, args.n, args.a, args.t) if v]
         try:
-            results = self.cur.execute(query, parameters).fetchall()
+            results = self.cur.execute(query, parameters)
 
         # Error if the query is unsuccessful
         except Exception as error:
-            sys.stderr.write(f"{sys.argv[0]}: {error}")
-            sys.exit(1)
+            raise RegDBDatabaseError(str(error)) from error
 
-        self.display_table(results)
+        # Rows are read while displaying, so SQLite can still fail here
+        try:
+            self.display_table(results)
+        except sqlite3.Error as error:
+            raise RegDBDatabaseError(str(error)) from error
 
     def get_details(self, args):
         """
@@ -91,12 +255,14 @@ class RegDB:
 
         Args:
             args (argparse.Namespace): Arguments from command line
+
+        Raises:
+            RegDBError: If the class ID is invalid or does not exist
         """
         class_id = args.classID
 
         if not str(class_id).isdigit():
-            sys.stderr.write("Error: Class ID must be a number")
-            sys.exit(1)
+            raise RegDBError("Error: Class ID must be a number")
 
         query = self.get_details_query()
         # Parameters set to fill in prepared statements
@@ -104,8 +270,7 @@ class RegDB:
         results = self.cur.execute(query, parameters).fetchall()
 
         if len(results) == 0:
-            sys.stderr.write(f"no class with classid {class_id} exists")
-            sys.exit(1)
+            raise RegDBError(f"no class with classid {class_id} exists")
 
         self.display_details(results)
 
@@ -119,42 +284,76 @@ class RegDB:
         Returns:
             query (str): SQL query
         """
-        dept = args.d
-        num = args.n
-        area = args.a
-        title = args.t
+        mask = self.get_search_mask(args)
+        query = self._queries.get(mask)
+        if query is None:
+            query = self.build_search_query(mask)
+            self._queries[mask] = query
+        return query
 
-        query = """
-        SELECT classid, dept, coursenum, area, title
-        FROM classes
-        INNER JOIN courses ON classes.courseid = courses.courseid
-        INNER JOIN crosslistings ON classes.courseid = crosslistings.courseid
+    def get_search_mask(self, args):
         """
+        Returns a bitmask of which search arguments are present.
 
-        # adding WHERE prepared clauses to the query
-        where = "WHERE "
-        if dept:
-            where += "dept LIKE ? escape '@' AND "
-        if num:
-            where += "coursenum LIKE ? escape '@' AND "
-        if area:
-            where += "area LIKE ? escape '@' AND "
-        if title:
-            where += "title LIKE ? escape '@' AND "
-
-        # Remove last AND
-        if where != "WHERE ":
-            where = where[:-5]
-        else:
-            where = ""
+        Args:
+            args (argparse.Namespace): Arguments from command line
 
-        # Adding WHERE to QUERY
-        query += where
+        Returns:
+            mask (int): Bits for -d, -n, -a, -t from high to low,
+                preceded by the same four bits for escaped wildcards
+        """
+        # Bits 3..0 mark which of -d, -n, -a, -t are present and bits
+        # 7..4 mark which of them need an ESCAPE clause, so masks range
+        # over 0-255. Only masks below NUM_SEARCH_QUERIES are prebuilt.
+        mask = (bool(args.d) << 3) | (bool(args.n) << 2) | \
+            (bool(args.a) << 1) | bool(args.t)
+        esc = (getattr(args, '_d_esc', False) << 3) | \
+            (getattr(args, '_n_esc', False) << 2) | \
+            (getattr(args, '_a_esc', False) << 1) | \
+            getattr(args, '_t_esc', False)
+        return (esc << 4) | mask
+
+    def build_search_query(self, mask):
+        """
+        Builds the SQL query for search from an argument bitmask.
 
-        # Adding ORDER BY
-        query += " ORDER BY dept, coursenum, classid"
+        Args:
+            mask (int): Bitmask as returned by get_search_mask
 
-        return query
+        Returns:
+            query (str): SQL query
+        """
+        if self._has_wide:
+            base_sql = """
+            SELECT classid, dept, coursenum, area, title
+            FROM classes_wide
+            """
+        else:
+            base_sql = """
+            SELECT classid, dept, coursenum, area, title
+            FROM classes
+            INNER JOIN courses ON classes.courseid = courses.courseid
+            INNER JOIN crosslistings ON classes.courseid = crosslistings.courseid
+            """
+
+        # adding WHERE prepared clauses to the query. The % wildcards
+        # are added in SQL so parameters are bound as typed.
+        # Every filter is a "contains" match (%value%), so no index
+        # can serve it whether written with LIKE, GLOB or lower(col);
+        # equality or range predicates would change which classes match.
+        # Titles are not narrowed by an indexed first-word prefix:
+        # -t science must also match titles where it is not the first word
+        clauses = []
+        for bit, column in zip((0b1000, 0b0100, 0b0010, 0b0001),
+                               self.SEARCH_COLUMNS):
+            if mask & bit:
+                clause = f"{column} LIKE ('%' || ? || '%')"
+                if mask & (bit << 4):
+                    clause += " escape '@'"
+                clauses.append(clause)
+
+        where = ("WHERE " + " AND ".join(clauses)) if clauses else ""
+        return f"{base_sql}{where} ORDER BY dept, coursenum, classid"
 
     def get_details_query(self):
         """
@@ -195,34 +394,25 @@ class RegDB:
         # Checking the length of results. This should never happen,
         # as errors should be caught be when query executed
         if len(res) != num_columns:
-            sys.stderr.write(
+            raise RegDBError(
                 "Error: Invalid number items in details display")
-            sys.exit(1)
 
-        # case for multiple depts and profs
-        dept_num = ""
-        profs = []
+        # case for multiple depts and profs. The dict keeps the first
+        # occurrence of each dept and number in query order.
+        dept_nums = {}
         for curr in results:
-            new_dept_num = f"{curr[6]} {curr[7]}"
-            if new_dept_num not in dept_num:
-                dept_num += f"Dept and Number: {new_dept_num}\n"
-            profs.append(curr[12])
-
-        profs = list(set(profs))
-        profs.sort()
-        prof_str = ""
-        for curr_prof in profs:
-            prof_str += f"Professor: {curr_prof}\n"
-
-        # Removing the last newline
-        prof_str = prof_str[:-1]
-
-        wrapped_descrip = textwrap.fill(
-            f"Description: {res[10]}", 72, break_long_words=False)
-        wrapped_title = textwrap.fill(
-            f"Title: {res[9]}", 72, break_long_words=False)
-        wrapped_prereqs = textwrap.fill(
-            f"Prerequisites: {res[11]}", 72, break_long_words=True)
+            dept_nums.setdefault(f"{curr[6]} {curr[7]}", None)
+        dept_num = "".join(
+            f"Dept and Number: {curr_dept_num}\n"
+            for curr_dept_num in dept_nums)
+
+        profs = sorted({curr[12] for curr in results})
+        prof_str = "\n".join(
+            f"Professor: {curr_prof}" for curr_prof in profs)
+
+        wrapped_descrip = _WRAPPER.fill(f"Description: {res[10]}")
+        wrapped_title = _WRAPPER.fill(f"Title: {res[9]}")
+        wrapped_prereqs = _WRAPPER_BLW.fill(f"Prerequisites: {res[11]}")
 
         print(f"Course Id: {res[0]}\n")
         print(f"Days: {res[1]}")
@@ -244,35 +434,69 @@ class RegDB:
     def display_table(self, results, max_len=72):
         """
         Creates and prints a table of results from a search query.
+        Rows are written in batches as they are read from results.
 
         Args:
-            results (list): Results of the search query
+            results (iterable): Results of the search query, either
+                a list or the cursor that executed it
             max_len (int): Maximum length of a line
         """
 
-        header = "ClsId Dept CrsNum Area Title"
-        underline = "----- ---- ------ ---- -----"
-        print(header)
-        print(underline)
+        out = ["ClsId Dept CrsNum Area Title",
+               "----- ---- ------ ---- -----"]
 
         for curr in results:
             classid, dept, coursenum, area, title = curr
 
             # Right aligning columns except title.
             # Info from https://docs.python.org/3/library/string.html
-            line = f"{classid:>5} {dept:>4} {coursenum:>6} " + \
-                f"{area:>4} {title}"
-            len_without_title = len(line) - len(title)
-
-            line = textwrap.fill(
-                line, max_len, subsequent_indent=" " *
-                len_without_title, break_long_words=False)
+            line = f"{classid:>5} {dept:>4} {coursenum:>6} {area:>4} {title}"
+
+            # Lines that fit and that textwrap would leave untouched
+            # (no trailing or special whitespace) skip wrapping.
+            if len(line) <= max_len and line.isprintable() \
+                    and not line.endswith(" "):
+                out.append(line)
+            else:
+                len_without_title = len(line) - len(title)
+                out.append(textwrap.fill(
+                    line, max_len, subsequent_indent=" " *
+                    len_without_title, break_long_words=False))
+
+            if len(out) >= self.TABLE_BATCH_SIZE:
+                self.write_lines(out)
+                out = []
+
+        if out:
+            self.write_lines(out)
+
+    def write_lines(self, lines):
+        """
+        Writes lines to stdout as a single encoded write to the
+        underlying binary buffer, when stdout has one and the platform
+        needs no newline translation.
 
-            print(line)
+        Args:
+            lines (list): Lines to write, without newlines
+        """
+        text = "\n".join(lines) + "\n"
+        stdout = sys.stdout
+        buffer = getattr(stdout, "buffer", None)
+        # The buffer bypasses the text layer's "\n" -> os.linesep
+        # translation, which print relies on elsewhere (e.g. Windows)
+        if buffer is None or os.linesep != "\n":
+            stdout.write(text)
+            return
+
+        # Keep ordering with anything already printed through stdout
+        stdout.flush()
+        buffer.write(text.encode(stdout.encoding, stdout.errors))
+        buffer.flush()
 
     def replace_wildcards(self, string):
         """
-        Replaces wildcard chars with escape chars + wildcard char.
+        Escapes wildcard chars and the '@' escape char itself
+        with a preceding '@', so they match literally.
 
         Args:
             string (str): String to replace wildcards in
@@ -280,22 +504,67 @@ class RegDB:
         Returns:
             string (str): String with wildcards replaced
         """
-        string = string.replace("%", "@%")
-        string = string.replace("_", "@_")
-        return string
+        return _WILDCARDS.sub(r"@\1", string)
 
     def format_args(self, args):
         """
         Removes wildcards, converts to lowercase,
-        and removes newline chars
+        and removes newline chars. Sets args._<key>_esc for
+        arguments that contained wildcards or "@" and so need escaping.
 
         Args:
-            args (list): List of arguments to format
+            args (argparse.Namespace): Arguments from command line
         """
-        for key, value in vars(args).items():
+        for key in ("d", "n", "a", "t"):
+            value = getattr(args, key)
             if value:
-                value = self.replace_wildcards(value)
-                value = value.lower()
-                value = value.replace("\n", "")
-                value = f"%{value}%"
+                needs_escape = "%" in value or "_" in value \
+                    or "@" in value
+                setattr(args, f"_{key}_esc", needs_escape)
+                if needs_escape:
+                    value = self.replace_wildcards(value)
+                value = value.lower().translate(_NO_NEWLINES)
                 setattr(args, key, value)
+
+
+def migrate(db_path="reg.sqlite"):
+    """
+    Migration that (re)builds the denormalized classes_wide table
+    used by RegDB searches, so that they need no joins.
+
+    classes_wide is a snapshot of classes, courses and crosslistings,
+    and regdetails.py still reads those tables directly. Re-run this
+    after any change to them, or searches and details will disagree.
+    Each run drops and rebuilds the table, and with it its indexes.
+    Processes with pooled connections should call _POOL.close_all()
+    afterwards so RegDB notices the new table.
+
+    iw_sort follows the search ORDER BY and covers every selected
+    column, so searches read it in order instead of sorting. There are
+    no per-column indexes: every search filter is a %value% LIKE,
+    which no index can serve.
+
+    Args:
+        db_path (str): Path to the registrar database
+    """
+    conn = sqlite3.connect(db_path, isolation_level=None)
+    try:
+        conn.executescript("""
+        BEGIN;
+        DROP TABLE IF EXISTS classes_wide;
+        CREATE TABLE classes_wide AS
+            SELECT classid, dept, coursenum, area, title
+            FROM classes
+            INNER JOIN courses ON classes.courseid = courses.courseid
+            INNER JOIN crosslistings
+                ON classes.courseid = crosslistings.courseid;
+        CREATE INDEX iw_sort
+            ON classes_wide (dept, coursenum, classid, area, title);
+        COMMIT;
+        """)
+    finally:
+        conn.close()
+
+
+if __name__ == '__main__':
+    migrate()
@@ -2,7 +2,8 @@
 Authors: George Toumbas, Shanzay Waseem
 """
 import argparse
-from reg_db import RegDB
+import sys
+from reg_db import RegDB, RegDBError, RegDBDatabaseError
 
 
 def main():
@@ -23,9 +24,16 @@ def main():
     # Parse the arguments
     args = parser.parse_args()
 
-    registrar_db = RegDB()
-    registrar_db.get_details(args)
-    registrar_db.close()
+    try:
+        registrar_db = RegDB()
+        registrar_db.get_details(args)
+        registrar_db.close()
+    except RegDBDatabaseError as error:
+        sys.stderr.write(f"{sys.argv[0]}: {error}")
+        sys.exit(1)
+    except RegDBError as error:
+        sys.stderr.write(str(error))
+        sys.exit(1)
 
 
 if __name__ == '__main__':